@@ -11,21 +11,45 @@ Features:
 - Timeout handling for upstream requests
 - Optional domain allow-listing for security
 - Dual-mode launcher: Flask dev server or Gunicorn production server
+
+Concurrency:
+The proxy is IO-bound, so it runs on gevent. The standard library is
+monkey-patched before anything else is imported, which makes `requests`,
+`socket` and `ssl` cooperative. Keep blocking C-extension IO (native DB
+drivers, C HTTP clients, etc.) out of the proxy path: gevent cannot patch it,
+and a single blocking call stalls every greenlet in the worker.
 """
 
+from gevent import monkey
+monkey.patch_all()
+
 from flask import Flask, request, Response
 import requests
-from urllib.parse import urljoin, quote, urlparse
+import urllib3
+from urllib.parse import urljoin, quote_from_bytes, urlparse
 import os
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 import multiprocessing
 from fake_useragent import UserAgent
 
-# Initialize fake_useragent once
+# Prefer the ada (WHATWG, C++) URL parser; fall back to urllib.parse
+try:
+    from ada_url import URL as AdaURL, join_url
+except ImportError:
+    AdaURL = None
+    join_url = urljoin
+
+# Pick a desktop browser UA (Windows/Chrome by default) once at startup
 try:
     ua = UserAgent()
-    user_agent = ua.chrome
+    USER_AGENT = ua.chrome
 except Exception:
-    user_agent = (
+    USER_AGENT = (
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
         "AppleWebKit/537.36 (KHTML, like Gecko) "
         "Chrome/120.0.0.0 Safari/537.36"
@@ -44,6 +68,11 @@ MAX_PLAYLIST_BYTES = int(os.environ.get("MAX_PLAYLIST_BYTES", 10 * 1024 * 1024))
 MAX_SEGMENT_BYTES = int(os.environ.get("MAX_SEGMENT_BYTES", 200 * 1024 * 1024))  # 200 MB max segment
 CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", 5.0))   # seconds
 READ_TIMEOUT = float(os.environ.get("READ_TIMEOUT", 20.0))        # seconds
+POOL_SIZE = int(os.environ.get("POOL_SIZE", 100))                 # keep-alive connections per host
+UPSTREAM_RCVBUF = int(os.environ.get("UPSTREAM_RCVBUF", 0))       # SO_RCVBUF bytes (0 = kernel autotuning)
+PLAYLIST_CACHE_SIZE = int(os.environ.get("PLAYLIST_CACHE_SIZE", 1024))  # rewritten playlists kept
+PLAYLIST_CACHE_TTL = float(os.environ.get("PLAYLIST_CACHE_TTL", 1.0))  # seconds before revalidating
+PLAYLIST_CACHE_BYTES = int(os.environ.get("PLAYLIST_CACHE_BYTES", 64 * 1024 * 1024))  # 64 MB of bodies per worker
 
 # Optional allowlist of hostnames (comma-separated via ALLOWED_HOSTS env var)
 ALLOWED_HOSTS = set(
@@ -51,41 +80,231 @@ ALLOWED_HOSTS = set(
     for h in os.environ.get("ALLOWED_HOSTS", "").split(",")
     if h.strip()
 )
+# Split into exact names and "*.example.com" wildcard suffixes for fast matching
+_EXACT_HOSTS = frozenset(h for h in ALLOWED_HOSTS if not h.startswith("*."))
+_SUFFIX_HOSTS = tuple(h[1:] for h in ALLOWED_HOSTS if h.startswith("*."))
+
+# Playlist lines to rewrite: anything but tags/comments, absolute URLs and blanks.
+# Anchored on a literal "\n" (rather than (?m)^) so the regex engine can skip
+# straight from line to line; callers prepend "\n" to cover the first line.
+_URL_LINE = re.compile(rb"\n(?!#|https?://|[^\S\n]*(?:\n|$))([^\r\n]+)")
+
+# ---------------------------------------------------------------------------
+# Upstream HTTP session (shared keep-alive connection pool)
+# ---------------------------------------------------------------------------
+# urllib3's defaults (TCP_NODELAY) plus an optional fixed SO_RCVBUF, which can
+# help long fat links but disables Linux receive-buffer autotuning
+_SOCKET_OPTIONS = list(urllib3.connection.HTTPConnection.default_socket_options)
+if UPSTREAM_RCVBUF > 0:
+    _SOCKET_OPTIONS.append((socket.SOL_SOCKET, socket.SO_RCVBUF, UPSTREAM_RCVBUF))
+
+class TunedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter that applies _SOCKET_OPTIONS to every pooled upstream socket,
+    for direct connections and those made through HTTP(S)_PROXY alike.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = _SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs["socket_options"] = _SOCKET_OPTIONS
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+SESSION = requests.Session()
+# requests advertises "gzip, deflate, br" when brotli is installed; bodies are
+# decoded on read (raw.read(decode_content=True)) before rewriting/streaming
+_adapter = TunedHTTPAdapter(
+    pool_connections=POOL_SIZE,
+    pool_maxsize=POOL_SIZE,
+    max_retries=urllib3.Retry(
+        total=2,
+        backoff_factor=0.1,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,  # pass the final upstream status through
+        respect_retry_after_header=False,  # don't let upstream stall us past READ_TIMEOUT
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+@lru_cache(maxsize=65536)
+def _host_allowed(hostname: str) -> bool:
+    # Cached per host: segment URLs are unique but their hosts repeat
+    host = hostname.lower()
+    return host in _EXACT_HOSTS or host.endswith(_SUFFIX_HOSTS)
 
 def validate_url(u: str):
-    p = urlparse(u)
-    if p.scheme not in ("http", "https"):
+    if AdaURL is not None:
+        try:
+            p = AdaURL(u)
+        except ValueError:
+            return False, "Malformed URL"
+        scheme, hostname = p.protocol[:-1], p.hostname
+        # ada keeps IPv6 literals bracketed; match urlparse's "::1" form
+        if hostname.startswith("["):
+            hostname = hostname[1:-1]
+    else:
+        p = urlparse(u)
+        scheme, hostname = p.scheme, p.hostname
+    if scheme not in ("http", "https"):
         return False, "Unsupported URL scheme"
-    if ALLOWED_HOSTS and p.hostname:
-        host = p.hostname.lower()
-        allowed = False
-        for h in ALLOWED_HOSTS:
-            if h.startswith("*.") and host.endswith(h[1:]):
-                allowed = True
-                break
-            if host == h:
-                allowed = True
-                break
-        if not allowed:
-            return False, f"Host {p.hostname} not allowed"
+    if ALLOWED_HOSTS and hostname and not _host_allowed(hostname):
+        return False, f"Host {hostname} not allowed"
     return True, None
 
+# ---------------------------------------------------------------------------
+# Utility: Resolve playlist entries against the playlist URL
+# ---------------------------------------------------------------------------
+def resolve_url(base, origin, line):
+    """
+    Resolve a playlist line against base (the playlist "directory" URL) and
+    origin (scheme://host[:port]). The common shapes are handled with plain
+    concatenation; only dot-segments and other odd cases go through the
+    full URL parser.
+
+    Returns (prefix, rest) whose concatenation is the absolute URL. On the
+    fast paths prefix is base or origin, so callers can percent-encode it
+    once per playlist and only encode rest per line.
+    """
+    if line[0] == "/" and line[1:2] != "/":
+        return origin, line
+    if ":" not in line and "./" not in line and line[0] != "/":
+        return base, line
+    try:
+        return "", join_url(base, line)
+    except ValueError:
+        return "", urljoin(base, line)
+
+def quote_all(s):
+    """
+    Percent-encode everything but unreserved characters (quote(s, safe="")).
+    """
+    return quote_from_bytes(s.encode(), safe="")
+
+# ---------------------------------------------------------------------------
+# Rewritten playlist cache: url -> (etag, body, headers, expires_at)
+# ---------------------------------------------------------------------------
+_PL_CACHE = OrderedDict()
+_PL_LOCK = threading.Lock()
+_pl_cache_bytes = 0  # total size of cached bodies
+
+def _pl_cache_pop(url):
+    # Remove url from the cache, keeping the byte total in step (lock held)
+    global _pl_cache_bytes
+    entry = _PL_CACHE.pop(url, None)
+    if entry is not None:
+        _pl_cache_bytes -= len(entry[1])
+
+def playlist_cache_get(url):
+    """
+    Return the cached entry for url, or None. Stale entries are returned
+    for ETag revalidation; stale ones without an ETag are dropped instead.
+    """
+    with _PL_LOCK:
+        entry = _PL_CACHE.get(url)
+        if entry is None:
+            return None
+        if not entry[0] and entry[3] <= time.monotonic():
+            _pl_cache_pop(url)
+            return None
+        _PL_CACHE.move_to_end(url)
+        return entry
+
+def playlist_cache_put(url, etag, body, headers):
+    """
+    Store a rewritten playlist and its response headers for
+    PLAYLIST_CACHE_TTL seconds. Least recently used entries are evicted
+    beyond PLAYLIST_CACHE_SIZE entries or PLAYLIST_CACHE_BYTES of bodies,
+    and bodies larger than the whole byte budget are not cached.
+    """
+    global _pl_cache_bytes
+    now = time.monotonic()
+    with _PL_LOCK:
+        _pl_cache_pop(url)
+        if len(body) > PLAYLIST_CACHE_BYTES:
+            return
+        _PL_CACHE[url] = (etag, body, headers, now + PLAYLIST_CACHE_TTL)
+        _pl_cache_bytes += len(body)
+        while len(_PL_CACHE) > PLAYLIST_CACHE_SIZE or _pl_cache_bytes > PLAYLIST_CACHE_BYTES:
+            _pl_cache_pop(next(iter(_PL_CACHE)))
+        # Expired entries without an ETag can never be served again
+        while _PL_CACHE:
+            oldest = next(iter(_PL_CACHE))
+            entry = _PL_CACHE[oldest]
+            if entry[0] or entry[3] > now:
+                break
+            _pl_cache_pop(oldest)
+
+def cached_playlist_response(entry):
+    """
+    Build a response from a playlist cache entry, answering 304 when the
+    client already holds the same ETag.
+    """
+    etag, body, headers, _ = entry
+    if etag and request.headers.get("If-None-Match") == etag:
+        return Response(b"", status=304, headers=headers)
+    return Response(body, headers=headers)
+
 # ---------------------------------------------------------------------------
 # Utility: Build CORS headers
 # ---------------------------------------------------------------------------
+BASE_CORS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "*",
+    "Access-Control-Allow-Methods": "GET, HEAD, OPTIONS",
+}
+
 def cors_headers(extra=None):
     """
     Return a dictionary of CORS headers, optionally merged with extra headers.
+    Without extra headers the shared BASE_CORS dict is returned; don't mutate it.
     """
-    headers = {
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Headers": "*",
-        "Access-Control-Allow-Methods": "GET, HEAD, OPTIONS",
-    }
-    if extra:
-        headers.update(extra)
+    return {**BASE_CORS, **extra} if extra else BASE_CORS
+
+# ---------------------------------------------------------------------------
+# Utility: Forward upstream response headers
+# ---------------------------------------------------------------------------
+# Playlist bodies are rewritten, so upstream length/range headers don't apply
+_PLAYLIST_DROP_HEADERS = frozenset({"content-length", "content-range", "accept-ranges"})
+
+_DROP_HEADERS = frozenset({
+    # Hop-by-hop headers (RFC 7230 section 6.1)
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade",
+    # Bodies are decoded on read, so the upstream coding no longer applies
+    "content-encoding",
+    # Scoped to the upstream origin; meaningless (or harmful) on ours
+    "set-cookie", "alt-svc", "strict-transport-security",
+    # Set by our own server / by the caller after normalization
+    "server", "date", "content-type",
+})
+
+def forward_headers(resp, drop=frozenset()):
+    """
+    Copy upstream response headers, minus hop-by-hop/origin-scoped ones and
+    any lowercase names in drop, merged with the CORS headers.
+    """
+    if "Content-Encoding" in resp.headers:
+        drop = drop | {"content-length"}
+    headers = {}
+    for k, v in resp.headers.items():
+        name = k.lower()
+        if name in _DROP_HEADERS or name in drop or name.startswith("access-control-"):
+            continue
+        headers[k] = v
+    headers.update(BASE_CORS)
     return headers
 
+def playlist_content_type(resp):
+    """
+    Return the upstream playlist Content-Type, normalized to an HLS type.
+    """
+    ctype = resp.headers.get("Content-Type", "")
+    if "mpegurl" not in ctype.lower():
+        return "application/vnd.apple.mpegurl"
+    return ctype
+
 # ---------------------------------------------------------------------------
 # Proxy endpoint
 # ---------------------------------------------------------------------------
@@ -100,6 +319,10 @@ def proxy():
     - Streams the response in chunks.
     - Enforces maximum segment size.
     """
+    # Answer CORS preflight directly; no upstream fetch needed
+    if request.method == "OPTIONS":
+        return Response("", status=204, headers=cors_headers({"Access-Control-Max-Age": "86400"}))
+
     url = request.args.get("url")
     if not url:
         return Response("Missing ?url= parameter", status=400, headers=cors_headers())
@@ -109,21 +332,76 @@ def proxy():
     if not ok:
         return Response(f"Invalid URL: {err}", status=400, headers=cors_headers())
 
+    # Normalize referer to just scheme://host[:port]/
+    p = urlparse(url)
+    referer = f"{p.scheme}://{p.netloc}/"
+    upstream_headers = {
+        "User-Agent": USER_AGENT,
+        "Referer": referer,
+    }
+    # Forward byte-range requests so players only pull what they seek to.
+    # Playlists are always fetched whole: a partial one can't be rewritten.
+    if "Range" in request.headers and not url.endswith(".m3u8"):
+        upstream_headers["Range"] = request.headers["Range"]
+        # Ranges must address the bytes we send, not a compressed encoding
+        upstream_headers["Accept-Encoding"] = "identity"
+
+    # Probe requests: answer from an upstream HEAD, no body transfer
+    if request.method == "HEAD":
+        try:
+            r = SESSION.head(
+                url,
+                allow_redirects=True,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                headers=upstream_headers,
+            )
+            if r.status_code in (403, 405, 501):
+                # Presigned/method-restricted URLs often refuse HEAD; take
+                # the headers of a GET instead, without reading its body
+                r = SESSION.get(
+                    url,
+                    stream=True,
+                    allow_redirects=True,
+                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                    headers=upstream_headers,
+                )
+                r.close()
+        except requests.RequestException as e:
+            return Response(f"Upstream fetch error: {e}", status=502, headers=cors_headers())
+        # Same size caps as the GET paths below
+        length = r.headers.get("Content-Length", "")
+        if url.endswith(".m3u8"):
+            if length.isdigit() and int(length) > MAX_PLAYLIST_BYTES:
+                return Response("Playlist too large", status=413, headers=cors_headers())
+            headers = forward_headers(r, _PLAYLIST_DROP_HEADERS)
+            headers["Content-Type"] = playlist_content_type(r)
+        else:
+            if length.isdigit() and int(length) > MAX_SEGMENT_BYTES:
+                return Response("Segment too large", status=413, headers=cors_headers())
+            headers = forward_headers(r, set() if length.isdigit() else {"content-length"})
+            headers["Content-Type"] = r.headers.get("Content-Type") or "application/octet-stream"
+        resp = Response(headers=headers, status=r.status_code)
+        resp.automatically_set_content_length = False  # keep upstream's length, if any
+        return resp
+
+    # Serve fresh playlists from cache; revalidate stale ones with their ETag
+    cached = None
+    use_cache = url.endswith(".m3u8") and PLAYLIST_CACHE_SIZE > 0
+    if use_cache:
+        cached = playlist_cache_get(url)
+        if cached and cached[3] > time.monotonic():
+            return cached_playlist_response(cached)
+        if cached and cached[0]:
+            upstream_headers["If-None-Match"] = cached[0]
+
     # Fetch upstream resource
     try:
-        # Pick a desktop browser UA (Windows/Chrome by default)
-        user_agent = ua.chrome
-        # Normalize referer to just scheme://host[:port]/
-        p = urlparse(url)
-        referer = f"{p.scheme}://{p.netloc}/"
-        r = requests.get(
+        r = SESSION.get(
             url,
             stream=True,
+            allow_redirects=True,
             timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
-            headers={
-                "User-Agent": user_agent,
-                "Referer": referer,
-            },
+            headers=upstream_headers,
         )
     except requests.RequestException as e:
         return Response(f"Upstream fetch error: {e}", status=502, headers=cors_headers())
@@ -132,39 +410,84 @@ def proxy():
     # Handle HLS playlist (.m3u8)
     # -----------------------------------------------------------------------
     if url.endswith(".m3u8"):
-        content = []
-        read = 0
-        # Read playlist in chunks, enforce max size
-        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-            if not chunk:
-                continue
-            read += len(chunk)
-            if read > MAX_PLAYLIST_BYTES:
-                return Response("Playlist too large", status=413, headers=cors_headers())
-            content.append(chunk)
+        # Upstream unchanged: extend the cached copy, refreshing its headers
+        # with any the 304 carries (Cache-Control, Expires, ...), and serve it
+        if cached and r.status_code == 304:
+            r.close()
+            etag, body, headers, _ = cached
+            headers = {**headers, **forward_headers(r, _PLAYLIST_DROP_HEADERS)}
+            playlist_cache_put(url, etag, body, headers)
+            return cached_playlist_response((etag, body, headers, None))
 
-        # Decode playlist text
-        text = b"".join(content).decode(r.encoding or "utf-8", errors="replace")
+        # Reject oversized playlists up front when the size is known
+        length = r.headers.get("Content-Length", "")
+        if length.isdigit() and int(length) > MAX_PLAYLIST_BYTES:
+            r.close()
+            return Response("Playlist too large", status=413, headers=cors_headers())
 
         # Rewrite relative URLs to go through proxy
         base = url.rsplit("/", 1)[0] + "/"
-        lines = []
-        for line in text.splitlines():
-            if line and not line.startswith("#") and not line.startswith("http"):
-                proxied = f"/proxy?url={quote(urljoin(base, line), safe='')}"
-                lines.append(proxied)
-            else:
-                lines.append(line)
-        body = "\n".join(lines)
-
-        # Normalize Content-Type
-        ctype = r.headers.get("Content-Type", "").lower()
-        if "mpegurl" not in ctype:
-            ctype = "application/vnd.apple.mpegurl"
-        else:
-            ctype = r.headers.get("Content-Type")
+        origin = referer[:-1]
+        quoted = {base: quote_all(base), origin: quote_all(origin), "": ""}
+
+        def rewrite_line(m):
+            """
+            re.sub callback: turn a matched URL line into a proxied URL.
+            """
+            prefix, rest = resolve_url(base, origin, m[1].decode("utf-8", "replace"))
+            return b"\n/proxy?url=" + (quoted[prefix] + quote_all(rest)).encode()
+
+        def rewrite_block(block):
+            """
+            Rewrite a block of complete playlist lines (bytes) in one regex
+            pass, returning it newline-terminated.
+            """
+            return _URL_LINE.sub(rewrite_line, b"\n" + block)[1:] + b"\n"
 
-        return Response(body, headers=cors_headers({"Content-Type": ctype}), status=r.status_code)
+        def rewrite():
+            """
+            Generator that rewrites the playlist chunk by chunk as it arrives,
+            carrying any partial trailing line over to the next chunk and
+            stopping once MAX_PLAYLIST_BYTES have been read.
+            """
+            read = 0
+            pending = b""
+            # Keep a copy of the rewritten body for the playlist cache
+            parts = [] if use_cache and r.status_code == 200 else None
+            cached_bytes = 0
+            try:
+                while True:
+                    chunk = r.raw.read(CHUNK_SIZE, decode_content=True)
+                    if not chunk:
+                        break
+                    read += len(chunk)
+                    if read > MAX_PLAYLIST_BYTES:
+                        pending = b""
+                        parts = None
+                        break
+                    block, sep, pending = (pending + chunk).rpartition(b"\n")
+                    if sep:
+                        out = rewrite_block(block)
+                        if parts is not None:
+                            cached_bytes += len(out)
+                            if cached_bytes > PLAYLIST_CACHE_BYTES:
+                                parts = None  # too big to cache; stop holding a copy
+                            else:
+                                parts.append(out)
+                        yield out
+                if pending:
+                    out = rewrite_block(pending)
+                    if parts is not None:
+                        parts.append(out)
+                    yield out
+            finally:
+                r.close()
+            if parts is not None:
+                playlist_cache_put(url, r.headers.get("ETag"), b"".join(parts), headers)
+
+        headers = forward_headers(r, _PLAYLIST_DROP_HEADERS)
+        headers["Content-Type"] = playlist_content_type(r)
+        return Response(rewrite(), headers=headers, status=r.status_code)
 
     # -----------------------------------------------------------------------
     # Handle other resources (segments, subtitles, etc.)
@@ -174,17 +497,35 @@ def proxy():
         Generator that streams upstream response in CHUNK_SIZE increments,
         enforcing MAX_SEGMENT_BYTES.
         """
+        # Chunks are yielded as-is rather than copied into pooled buffers:
+        # WSGI servers may hold on to a yielded object, so it has to be an
+        # immutable bytes, and urllib3 allocates one per read regardless.
+        # What does pile up under many streams is abandoned upstream
+        # connections, so release the response as soon as we stop reading.
         sent = 0
-        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-            if not chunk:
-                continue
-            sent += len(chunk)
-            if sent > MAX_SEGMENT_BYTES:
-                break
-            yield chunk
+        try:
+            while True:
+                chunk = r.raw.read(CHUNK_SIZE, decode_content=True)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                if sent > MAX_SEGMENT_BYTES:
+                    break
+                yield chunk
+        finally:
+            r.close()
+
+    # Reject oversized segments up front when the size is known, so a
+    # forwarded Content-Length never promises more than generate() sends
+    length = r.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > MAX_SEGMENT_BYTES:
+        r.close()
+        return Response("Segment too large", status=413, headers=cors_headers())
+
+    # Range/size and caching headers pass through (206 status included)
+    headers = forward_headers(r, set() if length.isdigit() else {"content-length"})
+    headers["Content-Type"] = r.headers.get("Content-Type") or "application/octet-stream"
 
-    headers = {"Content-Type": r.headers.get("Content-Type") or "application/octet-stream"}
-    headers.update(cors_headers())
     return Response(generate(), headers=headers, status=r.status_code)
 
 # ---------------------------------------------------------------------------
@@ -198,10 +539,12 @@ if __name__ == "__main__":
         from gunicorn.app.wsgiapp import run
         import sys
 
-        workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
+        workers = int(os.environ.get("WORKERS", 2 * multiprocessing.cpu_count() + 1))
         sys.argv = [
             "gunicorn",
             "-w", str(workers),
+            "-k", "gevent",
+            "--worker-connections", os.environ.get("WORKER_CONNECTIONS", "1000"),
             "-b", "0.0.0.0:3000",
             "--log-level", os.environ.get("LOG_LEVEL", "debug"),
             "--access-logfile", os.environ.get("ACCESS_LOGFILE", "-"),